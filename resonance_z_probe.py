@@ -24,10 +24,6 @@ import collections
 import math
 import numpy as np
 from datetime import datetime
-
-from matplotlib.backends.backend_pdf import PdfPages
-from matplotlib import font_manager, ticker
-import matplotlib.pyplot as plt
 from textwrap import wrap
 
 
@@ -43,10 +39,8 @@ MAX_SHAPER_FREQ = 150.0
 TestPoint = collections.namedtuple(
     "TestPoint",
     (
-        "time",
-        "accel_x",
-        "accel_y",
-        "accel_z",
+        # (N, 4) array of time, accel_x, accel_y, accel_z
+        "samples",
         "current_z",
     ),
 )
@@ -170,6 +164,13 @@ def calc_freq_response(raw_values):
     return CalibrationData(fx, px + py + pz, px, py, pz)
 
 
+def _rate_above(z, threshold):
+    # Fraction of the (median centered) z samples outside +/- threshold
+    if len(z) == 0:
+        return 0
+    return np.count_nonzero(np.abs(z) > threshold) / len(z)
+
+
 class ZVibrationHelper:
     """Helper to dynamically manage Z position and movement, including the vibration"""
 
@@ -181,13 +182,14 @@ class ZVibrationHelper:
         vib_dir = (0.0, 0.0, 1.0)
         s = math.sqrt(sum([d * d for d in vib_dir]))
         self._vib_dir = [d / s for d in vib_dir]
+        self.toolhead = None
 
     def _set_vibration_variables(self):
         """Calculate the axis coordinate difference to perform the vibration movement"""
         t_seg = 0.25 / self.frequency
         accel = self.accel_per_hz * self.frequency
         self.max_v = accel * t_seg
-        toolhead = self.printer.lookup_object("toolhead")
+        self.toolhead = toolhead = self.printer.lookup_object("toolhead")
         self.cur_x, self.cur_y, self.cur_z, self.cur_e = toolhead.get_position()
         toolhead.cmd_M204(self.gcode.create_gcode_command("M204", "M204", {"S": accel}))
         self.movement_span = 0.5 * accel * t_seg**2
@@ -197,13 +199,14 @@ class ZVibrationHelper:
         return (self._vib_dir[0] * l, self._vib_dir[1] * l, self._vib_dir[2] * l)
 
     def _vibrate_(self):
-        toolhead = self.printer.lookup_object("toolhead")
-        for sign in [1, -1]:
-            nX = self.cur_x + sign * self.dX
-            nY = self.cur_y + sign * self.dY
-            nZ = self.cur_z + sign * self.dZ
-            toolhead.move([nX, nY, nZ, self.cur_e], self.max_v)
-            toolhead.move([self.cur_x, self.cur_y, self.cur_z, self.cur_e], self.max_v)
+        # The vibration direction is fixed along Z, dX and dY are always 0
+        move = self.toolhead.move
+        x, y, z, e = self.cur_x, self.cur_y, self.cur_z, self.cur_e
+        dz, max_v = self.dZ, self.max_v
+        move([x, y, z + dz, e], max_v)
+        move([x, y, z, e], max_v)
+        move([x, y, z - dz, e], max_v)
+        move([x, y, z, e], max_v)
 
     def vibrate_n(self, n):
         self._set_vibration_variables()
@@ -217,7 +220,7 @@ class TapResonanceData:
     def __init__(self, test_points, out_path, gcmd):
         self.data = test_points
         self.gcmd = gcmd
-        self.ts = datetime.timestamp(datetime.now())
+        self.ts = datetime.now().strftime("%Y%m%d_%H%M%S")
         self.pdf_out = os.path.join(out_path, "tap_summary_%s.pdf" % self.ts)
         self.csv_out = os.path.join(out_path, "tap_summary_%s.csv" % self.ts)
 
@@ -225,28 +228,35 @@ class TapResonanceData:
         return len(self.data)
 
     def _rate_above_threshold(self, threshold):
-        rates = []
-        z_height = []
-        for t, x, y, z, curr_z in self.data:
-
-            rate_above_tr = sum(
-                np.logical_or(z > threshold, z < (-1 * threshold))
-            ) / len(t)
-            rates.append(rate_above_tr)
-            z_height.append(curr_z)
-        return (z_height, rates)
+        """Return a (z height, rate above threshold, test point) tuple per test"""
+        return [
+            (tp.current_z, _rate_above(tp.samples[:, 3], threshold), tp)
+            for tp in self.data
+        ]
 
     def plot(self, threshold, cycles):
+        # matplotlib is slow to import and heavy on the host, load it only
+        # when plots are actually requested. Plots only go to PDF, so force
+        # the non interactive backend instead of probing for a display
+        import matplotlib
+
+        matplotlib.use("Agg")
+        from matplotlib.backends.backend_pdf import PdfPages
+        from matplotlib import font_manager
+        import matplotlib.pyplot as plt
+
         try:
             rates_above_tr = self._rate_above_threshold(threshold)
             self.gcmd.respond_info("writing debug plots to %s" % self.pdf_out)
 
             with PdfPages(self.pdf_out) as pdf:
-                rates_indx = np.argsort(rates_above_tr[0])
+                z_height = np.array([res[0] for res in rates_above_tr])
+                rates = np.array([res[1] for res in rates_above_tr])
+                rates_indx = np.argsort(z_height)
 
                 plt.plot(
-                    np.sort(rates_above_tr[0]),
-                    np.array(rates_above_tr[1])[rates_indx.astype(int)],
+                    z_height[rates_indx],
+                    rates[rates_indx],
                     linestyle="-",
                     marker="o",
                 )
@@ -256,16 +266,20 @@ class TapResonanceData:
                 plt.ylabel("Rate of points above threshold")
                 pdf.savefig(facecolor="white")
                 plt.close()
-                for z_test in rates_above_tr[0]:
-                    raw_plot = self.plot_raw_accel(z_test, threshold)
+                # the accelerometer figure is built once and redrawn per z height
+                accel_fig, accel_axes = plt.subplots(nrows=3, sharex=True)
+                for _, _, test_point in rates_above_tr:
+                    raw_plot = self.plot_raw_accel(test_point, threshold, accel_axes)
                     pdf.savefig(raw_plot, facecolor="white")
-                    plt.close()
-                    # acc_plot = self.plot_accel(z_test, cycles, threshold)
+                    # acc_plot = self.plot_accel(
+                    #     test_point, cycles, threshold, accel_axes
+                    # )
                     # pdf.savefig(acc_plot, facecolor="white")
-                    # plt.close()
-                    freq_plot = self.plot_frequency(z_test, 200)
-                    pdf.savefig(freq_plot, facecolor="white")
-                    plt.close()
+                    freq_plot = self.plot_frequency(test_point, 200)
+                    if freq_plot is not None:
+                        pdf.savefig(freq_plot, facecolor="white")
+                        plt.close(freq_plot)
+                plt.close(accel_fig)
         except FileNotFoundError:
             self.gcmd.respond_info(" File %s not found" % self.pdf_out)
 
@@ -274,25 +288,29 @@ class TapResonanceData:
         try:
             with open(self.csv_out, "wt") as data_out:
                 data_out.write("#time,accel_x,accel_y,accel_z,z_height\n")
-                for t, x, y, z, curr_z in self.data:
-                    for i in range(len(t)):
-                        data_out.write(
-                            "%.6f,%.6f,%.6f,%.6f,%.6f\n"
-                            % (t[i], x[i], y[i], z[i], curr_z)
-                        )
+                for samples, curr_z in self.data:
+                    rows = np.column_stack((samples, np.full(len(samples), curr_z)))
+                    np.savetxt(data_out, rows, fmt="%.6f", delimiter=",")
         except FileNotFoundError:
             self.gcmd.respond_info(" File %s not found" % self.csv_out)
 
-    def plot_accel(self, z_height, cycles, threshold):
-        data = None
-        for t, x, y, z, curr_z in self.data:
-            if curr_z == z_height:
-                data = np.array((t, x, y, z))
-        if data is None:
-            self.gcmd.respond_info("No corresponding z_height found")
-            return None
+    def _accel_axes(self, axes):
+        """Return a 3 rows figure and axes, clearing the given axes for reuse"""
+        if axes is None:
+            import matplotlib.pyplot as plt
+
+            return plt.subplots(nrows=3, sharex=True)
+        for ax in axes:
+            ax.clear()
+        return (axes[0].figure, axes)
+
+    def plot_accel(self, test_point, cycles, threshold, axes=None):
+        from matplotlib import font_manager
+
+        data = test_point.samples.T
+        z_height = test_point.current_z
         logname = "%.4f" % z_height
-        fig, axes = plt.subplots(nrows=3, sharex=True)
+        fig, axes = self._accel_axes(axes)
         axes[0].set_title("\n".join(wrap("Accelerometer data z=%s" % logname, 15)))
         axis_names = ["Expected taps", "z-accel", "both"]
         first_time = data[0, 0]
@@ -301,11 +319,12 @@ class TapResonanceData:
         expect_freq = cycles / time_span
         expect_freq_start = (cycles + 1) / time_span
         sin_wave = np.sin(2 * np.pi * expect_freq * times)
-        sin_wave[sin_wave < 0] = 0
+        np.maximum(sin_wave, 0.0, out=sin_wave)
+        sin_wave = np.flip(sin_wave)
         cos_wave = np.cos(2 * np.pi * expect_freq_start * times)
-        cos_wave[cos_wave < 0] = 0
+        np.maximum(cos_wave, 0.0, out=cos_wave)
         ax = axes[0]
-        ax.plot(times, np.flip(sin_wave), alpha=0.8, label="Expected taps, sin flip")
+        ax.plot(times, sin_wave, alpha=0.8, label="Expected taps, sin flip")
         ax.plot(times, cos_wave, alpha=0.8, label="Expected taps, cos", color="red")
         # times = data[:, 0]
         adata = data[3, :]
@@ -313,11 +332,11 @@ class TapResonanceData:
         label = "\n".join(wrap(logname, 60))
         ax.plot(times, adata, alpha=0.8, label="z")
         ax.axhline(y=threshold, linestyle="--", lw=2, label="threshold", color="red")
-        ax.axhline(y=-1 * threshold, linestyle="--", lw=2, color="red")
+        ax.axhline(y=-threshold, linestyle="--", lw=2, color="red")
         ax = axes[2]
-        ax.plot(times, adata * np.flip(sin_wave), alpha=0.8, label="normalized")
+        ax.plot(times, adata * sin_wave, alpha=0.8, label="normalized")
         ax.axhline(y=threshold, linestyle="--", lw=2, label="threshold", color="red")
-        ax.axhline(y=-1 * threshold, linestyle="--", lw=2, color="red")
+        ax.axhline(y=-threshold, linestyle="--", lw=2, color="red")
         axes[-1].set_xlabel("Time (s)")
         fontP = font_manager.FontProperties()
         fontP.set_size("x-small")
@@ -329,16 +348,13 @@ class TapResonanceData:
         fig.tight_layout()
         return fig
 
-    def plot_raw_accel(self, z_height, threshold):
-        data = None
-        for t, x, y, z, curr_z in self.data:
-            if curr_z == z_height:
-                data = np.array((t, x, y, z))
-        if data is None:
-            self.gcmd.respond_info("No corresponding z_height found")
-            return None
+    def plot_raw_accel(self, test_point, threshold, axes=None):
+        from matplotlib import font_manager
+
+        data = test_point.samples.T
+        z_height = test_point.current_z
         logname = "%.4f" % z_height
-        fig, axes = plt.subplots(nrows=3, sharex=True)
+        fig, axes = self._accel_axes(axes)
         axes[0].set_title("\n".join(wrap("Accelerometer data z=%s" % logname, 15)))
         axis_names = ["x-accel", "y-accel", "z-accel"]
         first_time = data[0, 0]
@@ -352,7 +368,7 @@ class TapResonanceData:
                 ax.axhline(
                     y=threshold, linestyle="--", lw=2, label="threshold", color="red"
                 )
-                ax.axhline(y=-1 * threshold, linestyle="--", lw=2, color="red")
+                ax.axhline(y=-threshold, linestyle="--", lw=2, color="red")
         axes[-1].set_xlabel("Time (s)")
         fontP = font_manager.FontProperties()
         fontP.set_size("x-small")
@@ -364,13 +380,14 @@ class TapResonanceData:
         fig.tight_layout()
         return fig
 
-    def plot_frequency(self, z_height, max_freq):
-        calibration_data = None
-        for t, x, y, z, curr_z in self.data:
-            if curr_z == z_height:
-                calibration_data = calc_freq_response(np.array((t, x, y, z)))
+    def plot_frequency(self, test_point, max_freq):
+        from matplotlib import font_manager, ticker
+        import matplotlib.pyplot as plt
+
+        z_height = test_point.current_z
+        calibration_data = calc_freq_response(test_point.samples.T)
         if calibration_data is None:
-            self.gcmd.respond_info("No corresponding z_height found")
+            self.gcmd.respond_info("Not enough samples at z_height %.4f" % z_height)
             return None
         freqs = calibration_data.freq_bins
         psd = calibration_data.psd_sum[freqs <= max_freq]
@@ -410,7 +427,6 @@ class OffsetHelper:
 
     def __init__(self, pos, step, min_precision=0.005) -> None:
 
-        self.last_tested_pos = None
         self.step = step
         self.last_tested_pos = (pos, False)
         self.min_precision = min_precision
@@ -421,24 +437,21 @@ class OffsetHelper:
     def next_position(self):
         if self.finished:
             return self.current_offset
-        else:
-            if self.started is False:
-                return self.last_tested_pos[0]
-            else:
-                pos, status = self.last_tested_pos
-                if status == True:
-                    self.current_offset = pos
-                    if self.step <= self.min_precision:
-                        self.finished = True
-                    return pos + self.step
-                else:
-                    return pos - self.step
+        if self.started is False:
+            return self.last_tested_pos[0]
+        pos, status = self.last_tested_pos
+        if status:
+            return pos + self.step
+        return pos - self.step
 
     def last_tested_position(self, position, triggered):
         self.last_tested_pos = (position, triggered)
         self.started = True
         if triggered:
-            self.step = self.step / 2.0
+            self.current_offset = position
+            self.step /= 2.0
+            if self.step <= self.min_precision:
+                self.finished = True
 
 
 class ResonanceZProbe:
@@ -525,23 +538,13 @@ class ResonanceZProbe:
         while cycle_counter <= cycle_per_test:
             vibration_helper._vibrate_()
             cycle_counter += 1
-        timestamps = []
-        x_data = []
-        y_data = []
-        z_data = []
         aclient.finish_measurements()
-        for t, accel_x, accel_y, accel_z in aclient.get_samples():
-            timestamps.append(t)
-            x_data.append(accel_x)
-            y_data.append(accel_y)
-            z_data.append(accel_z)
-        x = np.asarray(x_data)
-        y = np.asarray(y_data)
-        z = np.asarray(z_data)
-        x = x - np.median(x)
-        y = y - np.median(y)
-        z = z - np.median(z)
-        calibration_data = calc_freq_response(np.array((timestamps, x, y, z)))
+        # (N, 4) array of time, accel_x, accel_y, accel_z
+        samples = np.asarray(aclient.get_samples(), dtype=np.float64).reshape(-1, 4)
+        # center x and y too: their PSDs decide whether z is the dominant axis
+        samples[:, 1:] -= np.median(samples[:, 1:], axis=0)
+        timestamps, z = samples[:, 0], samples[:, 3]
+        calibration_data = calc_freq_response(samples.T)
         freqs = calibration_data.freq_bins
         psd_sums = (
             np.sum(calibration_data.psd_x[freqs >= 80]),
@@ -549,15 +552,10 @@ class ResonanceZProbe:
             np.sum(calibration_data.psd_z[freqs >= 80]),
         )
         z_psd_is_max = np.argmax(psd_sums) == 2
-        try:
-            rate_above_tr = sum(
-                np.logical_or(z > self.amp_threshold, z < (-1 * self.amp_threshold))
-            ) / len(timestamps)
-        except ZeroDivisionError:
-            rate_above_tr = 0
+        rate_above_tr = _rate_above(z, self.amp_threshold)
 
         if len(timestamps) > 0:
-            test_time = timestamps[len(timestamps) - 1] - timestamps[0]
+            test_time = timestamps[-1] - timestamps[0]
             actual_freq = self.cycle_per_test / test_time
         else:
             test_time = 0
@@ -583,7 +581,7 @@ class ResonanceZProbe:
         )
         gcmd.respond_info("psd sums x: %.3f y: %.3f z: %.3f" % psd_sums)
         data_points = TapResonanceData(
-            [TestPoint(timestamps, x, y, z, z_pos)], out_path, gcmd
+            [TestPoint(samples, z_pos)], out_path, gcmd
         )
         data_points.write_data()
         data_points.plot(amp_threshold, cycle_per_test)
@@ -666,24 +664,13 @@ class ResonanceZProbe:
         while cycle_counter <= self.cycle_per_test:
             self.vibration_helper._vibrate_()
             cycle_counter += 1
-        timestamps = []
-        x_data = []
-        y_data = []
-        z_data = []
         aclient.finish_measurements()
-        for t, accel_x, accel_y, accel_z in aclient.get_samples():
-            timestamps.append(t)
-            x_data.append(accel_x)
-            y_data.append(accel_y)
-            z_data.append(accel_z)
-
-        x = np.asarray(x_data)
-        y = np.asarray(y_data)
-        z = np.asarray(z_data)
-        x = x - np.median(x)
-        y = y - np.median(y)
-        z = z - np.median(z)
-        calibration_data = calc_freq_response(np.array((timestamps, x, y, z)))
+        # (N, 4) array of time, accel_x, accel_y, accel_z
+        samples = np.asarray(aclient.get_samples(), dtype=np.float64).reshape(-1, 4)
+        # center x and y too: their PSDs decide whether z is the dominant axis
+        samples[:, 1:] -= np.median(samples[:, 1:], axis=0)
+        timestamps, z = samples[:, 0], samples[:, 3]
+        calibration_data = calc_freq_response(samples.T)
         freqs = calibration_data.freq_bins
         psd_sums = (
             np.sum(calibration_data.psd_x[freqs >= 80]),
@@ -691,16 +678,11 @@ class ResonanceZProbe:
             np.sum(calibration_data.psd_z[freqs >= 80]),
         )
         z_psd_is_max = np.argmax(psd_sums) == 2
-        try:
-            rate_above_tr = sum(
-                np.logical_or(z > self.amp_threshold, z < (-1 * self.amp_threshold))
-            ) / len(timestamps)
-        except ZeroDivisionError:
-            rate_above_tr = 0
+        rate_above_tr = _rate_above(z, self.amp_threshold)
 
         if self.debug == 1:
             if len(timestamps) > 0:
-                test_time = timestamps[len(timestamps) - 1] - timestamps[0]
+                test_time = timestamps[-1] - timestamps[0]
                 actual_freq = self.cycle_per_test / test_time
             else:
                 test_time = 0
@@ -725,7 +707,7 @@ class ResonanceZProbe:
             )
             gcmd.respond_info("psd sums x: %.3f y: %.3f z: %.3f" % psd_sums)
         if self.dump:
-            self.data_points.append(TestPoint(timestamps, x, y, z, curr_z))
+            self.data_points.append(TestPoint(samples, curr_z))
         return (rate_above_tr, z_psd_is_max)
 
 